@@ -1,75 +1,321 @@
+# Patch the stdlib before firebase_admin/grpc are imported so Firestore
+# I/O yields to other greenlets instead of blocking the worker
+from gevent import monkey
+monkey.patch_all()
+
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+import atexit
+import base64
+import hashlib
+import logging
 import os
+import queue
 import threading
 import time
-from flask import Flask, jsonify, render_template, request
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from flask import Flask, g, jsonify, render_template, request
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
+from gevent.pool import Group
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+import orjson
+from numba import njit
 
 # Suppress Firebase warnings
 os.environ['GRPC_VERBOSITY'] = 'ERROR'
 os.environ['GLOG_minloglevel'] = '2'
 
+# Handlers only enqueue records; a QueueListener formats and writes them to
+# stderr later. Under gevent the listener is a greenlet on the same hub, so
+# the write still blocks the worker while it runs, just outside the request.
+# Set LOG_LEVEL=INFO to see per-request messages.
+logger = logging.getLogger('forex_dashboard')
+log_level = logging.getLevelName(os.environ.get('LOG_LEVEL', 'WARNING').upper())
+logger.setLevel(log_level if isinstance(log_level, int) else logging.WARNING)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 app = Flask(__name__)
 
-# Initialize Firebase
-cred = credentials.Certificate('firebase-key.json')
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+def fast_json(data, status=200):
+    """jsonify() replacement that serializes with orjson"""
+    return app.response_class(orjson.dumps(data, default=str), status=status, mimetype='application/json')
+
+def init_firebase():
+    """The one place the service-account key is read; safe to call more than once"""
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate('firebase-key.json'))
+
+# Created on first use so no gRPC channel exists before gunicorn forks its
+# workers, whatever server or command loaded the app
+@lru_cache(maxsize=1)
+def get_db():
+    init_firebase()
+    return firestore.client()
+
+# Firestore rejects write batches larger than this
+FIRESTORE_BATCH_LIMIT = 500
+
+# Short-lived cache so dashboard polling doesn't re-read the same trades
+trades_cache = TTLCache(maxsize=16, ttl=5)
+trades_cache_lock = threading.Lock()
+
+# Formats MT5's TimeToString() produces with TIME_SECONDS and with its default
+# TIME_MINUTES, e.g. 2024.01.15 10:30:45 and 2024.01.15 10:30
+MT5_TIMESTAMP_FORMATS = ('%Y.%m.%d %H:%M:%S', '%Y.%m.%d %H:%M')
+
+def timestamp_to_ms(value):
+    """Epoch milliseconds for an uploaded trade timestamp, or None if it can't be parsed"""
+    for timestamp_format in MT5_TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.strptime(value, timestamp_format)
+            break
+        except (TypeError, ValueError):
+            continue
+    else:
+        try:
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    
+    # Naive times are treated as UTC so ordering doesn't depend on the server's timezone
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+def encode_cursor(trade_timestamp, doc_id):
+    """Opaque /api/trades page cursor holding the last trade's timestamp and document id"""
+    return base64.urlsafe_b64encode(orjson.dumps([trade_timestamp, doc_id])).decode()
+
+def decode_cursor(cursor):
+    try:
+        trade_timestamp, doc_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(trade_timestamp, str) or not isinstance(doc_id, str):
+        raise ValueError('Invalid cursor')
+    return trade_timestamp, doc_id
+
+@njit(cache=True)
+def equity_cumsum(profits):
+    """Running total of a float64 profit array, compiled to a tight loop"""
+    out = np.empty_like(profits)
+    running = 0.0
+    for i in range(profits.size):
+        running += profits[i]
+        out[i] = running
+    return out
+
+class TradeUploadError(Exception):
+    """Upload failed part way; uploaded_count trades were committed before the failure"""
+    def __init__(self, message, uploaded_count):
+        super().__init__(message)
+        self.uploaded_count = uploaded_count
 
 class OnlineFirebaseService:
     def __init__(self):
         self.trades_collection = 'trades'
+        self._trade_id_table = str.maketrans({' ': '_', ':': '-', '.': '_'})
         
     def process_uploaded_trades(self, trades_list):
-        """Process trades uploaded via API"""
-        uploaded_count = 0
+        """Process trades uploaded via API.
+        
+        Returns the number of trades written and a list describing each trade
+        that was rejected as malformed, so the uploader can tell what was lost.
+        """
+        db = get_db()
+        collection = db.collection(self.trades_collection)
+        pending = []
+        rejected = []
         
-        for trade_data in trades_list:
+        for index, trade_data in enumerate(trades_list):
+            trade_id = None
             try:
-                trade_id = f"{trade_data['symbol']}_{trade_data['timestamp'].replace(' ', '_').replace(':', '-').replace('.', '_')}"
-                doc_ref = db.collection(self.trades_collection).document(trade_id)
+                trade_id = f"{trade_data['symbol']}_{trade_data['timestamp'].translate(self._trade_id_table)}"
+                # Store profit as a double so reads never have to parse it
+                trade_data['profit'] = float(trade_data.get('profit', 0))
+                
+                # The equity curve orders by timestamp_ms, so a trade without it would never be charted
+                timestamp_ms = timestamp_to_ms(trade_data['timestamp'])
+                if timestamp_ms is None:
+                    raise ValueError(f"unrecognized timestamp {trade_data['timestamp']!r}")
+                trade_data['timestamp_ms'] = timestamp_ms
+                
+                pending.append((collection.document(trade_id), trade_data))
                 
-                if not doc_ref.get().exists:
-                    trade_data['firebase_timestamp'] = firestore.SERVER_TIMESTAMP
-                    doc_ref.set(trade_data)
-                    uploaded_count += 1
-                    print(f"✅ Uploaded: {trade_data['symbol']} {trade_data['trade_type']} - ${trade_data['profit']}")
-                    
             except Exception as e:
-                print(f"Error processing trade: {e}")
+                logger.warning("Rejecting trade %s: %s", trade_id or f"#{index}", e)
+                rejected.append({'index': index, 'trade_id': trade_id, 'error': str(e)})
                 continue
+        
+        if not pending:
+            return 0, rejected
+        
+        uploaded_count = 0
+        try:
+            # Check every trade for existence in a single round-trip
+            existing = {snap.reference.path for snap in db.get_all([doc_ref for doc_ref, _ in pending]) if snap.exists}
+            
+            batch = db.batch()
+            batch_trades = []
+            
+            for doc_ref, trade_data in pending:
+                if doc_ref.path in existing:
+                    continue
+                
+                # Guard against the same trade appearing twice in one upload
+                existing.add(doc_ref.path)
+                trade_data['firebase_timestamp'] = firestore.SERVER_TIMESTAMP
+                batch.set(doc_ref, trade_data)
+                batch_trades.append(trade_data)
+                
+                if len(batch_trades) == FIRESTORE_BATCH_LIMIT:
+                    uploaded_count += self._commit_batch(batch, batch_trades)
+                    batch = db.batch()
+                    batch_trades = []
+            
+            if batch_trades:
+                uploaded_count += self._commit_batch(batch, batch_trades)
+                
+        except Exception as e:
+            raise TradeUploadError(str(e), uploaded_count) from e
+            
+        finally:
+            # Earlier batches may have landed even if a later one failed
+            if uploaded_count:
+                with trades_cache_lock:
+                    trades_cache.clear()
                 
-        return uploaded_count
+        return uploaded_count, rejected
+    
+    def _commit_batch(self, batch, batch_trades):
+        batch.commit()
+        for trade_data in batch_trades:
+            logger.info("✅ Uploaded: %s %s - $%s", trade_data['symbol'], trade_data.get('trade_type'), trade_data.get('profit'))
+        return len(batch_trades)
 
 firebase_service = OnlineFirebaseService()
 
 class ForexDashboard:
+    # Fields sent back to clients; anything else (e.g. firebase_timestamp) stays on the server
+    _return_fields = [
+        'symbol', 'trade_type', 'lots', 'open_price', 'close_price',
+        'profit', 'open_time', 'close_time', 'timestamp'
+    ]
+    
     def __init__(self):
         self.trades_collection = 'trades'
     
-    def get_trades_from_firebase(self, limit=50):
+    # etag only keys the cache: a page cached under an ETag was fetched after that
+    # ETag was computed, so it is never older than the ETag it is served with
+    @cached(trades_cache, key=lambda self, limit, start_after, etag: hashkey(limit, start_after, etag), lock=trades_cache_lock)
+    def _fetch_trades(self, limit, start_after, etag):
+        collection = get_db().collection(self.trades_collection)
+        trades_ref = collection.select(self._return_fields)
+        # Trades from different symbols can share a timestamp, so the document id breaks ties
+        trades_ref = trades_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        trades_ref = trades_ref.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+        if start_after:
+            trade_timestamp, doc_id = start_after
+            trades_ref = trades_ref.start_after({
+                'timestamp': trade_timestamp,
+                FieldPath.document_id(): collection.document(doc_id)
+            })
+        trades_ref = trades_ref.limit(limit)
+        
+        docs = list(trades_ref.stream())
+        trades = [doc.to_dict() for doc in docs]
+        
+        # A short page means there is nothing left to fetch
+        next_cursor = None
+        if len(docs) == limit:
+            next_cursor = encode_cursor(trades[-1].get('timestamp'), docs[-1].id)
+        
+        return trades, next_cursor
+    
+    def get_trades_from_firebase(self, limit=50, start_after=None, etag=None):
+        """Newest trades first, plus the cursor for the next page (None on the last page).
+        
+        start_after is a decoded cursor from a previous page; etag is the
+        ETag the page will be served with, if any. Errors are logged and
+        re-raised so a failed read is never served as an empty page.
+        """
         try:
-            trades_ref = db.collection(self.trades_collection)
-            trades_ref = trades_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
-            trades_ref = trades_ref.limit(limit)
-            
-            trades = []
-            for doc in trades_ref.stream():
-                trade_data = doc.to_dict()
-                if 'firebase_timestamp' in trade_data:
-                    del trade_data['firebase_timestamp']
-                trades.append(trade_data)
-            
-            return trades
+            return self._fetch_trades(limit, start_after, etag)
             
         except Exception as e:
-            print(f"Error getting trades: {e}")
-            return []
+            logger.error("Error getting trades: %s", e)
+            raise
+    
+    def iter_trades_for_equity(self, limit=100):
+        """Latest trades in ascending time order, with only the fields the equity curve reads"""
+        trades_ref = get_db().collection(self.trades_collection)
+        trades_ref = trades_ref.select(['profit', 'close_time', 'timestamp'])
+        trades_ref = trades_ref.order_by('timestamp_ms', direction=firestore.Query.ASCENDING)
+        trades_ref = trades_ref.limit_to_last(limit)
+        
+        # limit_to_last queries can't be streamed
+        for doc in trades_ref.get():
+            yield doc.to_dict()
+    
+    def count_trades(self):
+        return get_db().collection(self.trades_collection).count().get()[0][0].value
+    
+    def _sum_profit(self):
+        return get_db().collection(self.trades_collection).sum('profit').get()[0][0].value or 0
+    
+    def _count_winning_trades(self):
+        trades_ref = get_db().collection(self.trades_collection)
+        return trades_ref.where(filter=FieldFilter('profit', '>', 0)).count().get()[0][0].value
+    
+    def _get_last_trade_time(self):
+        trades_ref = get_db().collection(self.trades_collection)
+        last_trades = trades_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
+        if not last_trades:
+            return 'Unknown'
+        return last_trades[0].to_dict().get('timestamp', 'Unknown')
+    
+    def get_trades_snapshot(self):
+        """Trade count and latest trade time; together they change whenever a trade is added"""
+        total_trades, last_trade_time = Group().map(
+            lambda query: query(),
+            (self.count_trades, self._get_last_trade_time)
+        )
+        return total_trades, last_trade_time
     
-    def calculate_stats(self, trades):
-        if not trades:
+    def get_stats_from_firebase(self, snapshot=None):
+        """Compute dashboard stats with server-side aggregation queries.
+        
+        snapshot is a (total_trades, last_trade_time) pair from get_trades_snapshot
+        when the caller already has one.
+        """
+        queries = [self._sum_profit, self._count_winning_trades]
+        if snapshot is None:
+            queries += [self.count_trades, self._get_last_trade_time]
+        
+        # The queries are independent, so run them side by side on greenlets
+        results = Group().map(lambda query: query(), queries)
+        total_profit, winning_trades = results[:2]
+        total_trades, last_trade_time = snapshot or results[2:]
+        
+        return self.build_stats(total_trades, total_profit, winning_trades, last_trade_time)
+    
+    def build_stats(self, total_trades, total_profit, winning_trades, last_trade_time):
+        if not total_trades:
             return {
                 'total_trades': 0,
                 'total_profit': 0,
@@ -80,19 +326,9 @@ class ForexDashboard:
                 'last_trade_time': 'No trades yet'
             }
         
-        total_trades = len(trades)
-        total_profit = sum(float(trade.get('profit', 0)) for trade in trades)
-        winning_trades = sum(1 for trade in trades if float(trade.get('profit', 0)) > 0)
         losing_trades = total_trades - winning_trades
-        win_rate = (winning_trades / total_trades) * 100 if total_trades > 0 else 0
-        avg_profit = total_profit / total_trades if total_trades > 0 else 0
-        
-        last_trade_time = 'No trades yet'
-        if trades:
-            try:
-                last_trade_time = trades[0]['timestamp']
-            except:
-                last_trade_time = 'Unknown'
+        win_rate = (winning_trades / total_trades) * 100
+        avg_profit = total_profit / total_trades
         
         return {
             'total_trades': total_trades,
@@ -106,74 +342,112 @@ class ForexDashboard:
 
 dashboard = ForexDashboard()
 
+# Uploads only add trades, so count plus latest timestamp catches every new
+# trade, but not trades rewritten in place (e.g. by migrate_trades.py). Bump
+# this whenever stored trades or the response shape change, so ETags handed
+# out by earlier versions stop matching.
+TRADES_ETAG_VERSION = 2
+
+def with_trades_etag(view):
+    """Answer 304 Not Modified when the trades haven't changed since the client's ETag"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            snapshot = dashboard.get_trades_snapshot()
+        except Exception as e:
+            logger.warning("Error computing trades ETag: %s", e)
+            return view(*args, **kwargs)
+        
+        etag = hashlib.md5(f"{TRADES_ETAG_VERSION}-{snapshot[0]}-{snapshot[1]}".encode()).hexdigest()
+        # If-None-Match uses weak comparison (RFC 9110 13.1.2), so W/ tags added by proxies still match
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Let the view reuse these instead of querying them again
+        g.trades_snapshot = snapshot
+        g.trades_etag = etag
+        
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    return wrapper
+
 # Routes
 @app.route('/')
 def home():
     return render_template('dashboard.html')
 
 @app.route('/api/stats')
+@with_trades_etag
 def get_stats():
     try:
-        trades = dashboard.get_trades_from_firebase(1000)
-        stats = dashboard.calculate_stats(trades)
-        return jsonify(stats)
+        stats = dashboard.get_stats_from_firebase(g.get('trades_snapshot'))
+        return fast_json(stats)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return fast_json({'error': str(e)}, 500)
 
 @app.route('/api/trades')
+@with_trades_etag
 def get_trades():
     try:
         limit = request.args.get('limit', 50, type=int)
-        trades = dashboard.get_trades_from_firebase(limit)
-        return jsonify(trades)
+        if limit < 1:
+            return fast_json({'error': 'limit must be at least 1'}, 400)
+        
+        after = request.args.get('after')
+        try:
+            start_after = decode_cursor(after) if after else None
+        except ValueError as e:
+            return fast_json({'error': str(e)}, 400)
+        
+        trades, next_cursor = dashboard.get_trades_from_firebase(limit, start_after=start_after, etag=g.get('trades_etag'))
+        
+        return fast_json({
+            'trades': trades,
+            'next_cursor': next_cursor
+        })
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return fast_json({'error': str(e)}, 500)
 
 @app.route('/api/equity-curve', methods=['GET'])
 def equity_curve():
     """Get equity curve data for charting"""
     try:
-        print("📊 Equity curve endpoint called")
-        
-        trades = dashboard.get_trades_from_firebase(100)
-        
-        if not trades:
-            print("⚠️ No trades found")
-            return jsonify([])
+        logger.info("📊 Equity curve endpoint called")
         
-        print(f"✅ Found {len(trades)} trades")
+        dates = []
+        profits = []
+        for trade in dashboard.iter_trades_for_equity(100):
+            dates.append(trade.get('close_time', trade.get('timestamp', '')))
+            profits.append(trade.get('profit', 0.0))
         
-        # Sort trades by timestamp
-        sorted_trades = sorted(
-            trades, 
-            key=lambda x: x.get('timestamp', ''), 
-            reverse=False
-        )
+        if not profits:
+            logger.info("⚠️ No trades found")
+            return fast_json([])
         
-        equity_data = []
-        running_profit = 0
+        logger.info("✅ Found %d trades", len(profits))
         
-        for trade in sorted_trades:
-            profit = float(trade.get('profit', 0))
-            running_profit += profit
-            trade_time = trade.get('close_time', trade.get('timestamp', ''))
-            
-            equity_data.append({
+        equity = np.round(equity_cumsum(np.asarray(profits, dtype=np.float64)), 2).tolist()
+        equity_data = [
+            {
                 'date': trade_time,
-                'equity': round(running_profit, 2)
-            })
+                'equity': running_profit
+            }
+            for trade_time, running_profit in zip(dates, equity)
+        ]
         
-        print(f"📈 Returning {len(equity_data)} equity points")
-        return jsonify(equity_data)
+        logger.info("📈 Returning %d equity points", len(equity_data))
+        return fast_json(equity_data)
         
     except Exception as e:
-        print(f"❌ Equity curve error: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({
+        logger.exception("❌ Equity curve error: %s", e)
+        return fast_json({
             'error': str(e),
             'message': 'Failed to load equity curve'
-        }), 500
+        }, 500)
 
 @app.route('/api/upload-trades', methods=['POST'])
 def upload_trades():
@@ -182,19 +456,26 @@ def upload_trades():
         trade_data = request.json
         
         if isinstance(trade_data, list):
-            uploaded_count = firebase_service.process_uploaded_trades(trade_data)
+            uploaded_count, rejected = firebase_service.process_uploaded_trades(trade_data)
         else:
-            uploaded_count = firebase_service.process_uploaded_trades([trade_data])
+            uploaded_count, rejected = firebase_service.process_uploaded_trades([trade_data])
+        
+        message = f'Successfully uploaded {uploaded_count} trades'
+        if rejected:
+            message += f', rejected {len(rejected)} malformed trades'
             
         return jsonify({
             'success': True,
             'uploaded_count': uploaded_count,
-            'message': f'Successfully uploaded {uploaded_count} trades'
+            'rejected_count': len(rejected),
+            'rejected': rejected,
+            'message': message
         })
         
     except Exception as e:
         return jsonify({
             'success': False,
+            'uploaded_count': getattr(e, 'uploaded_count', 0),
             'error': str(e),
             'message': 'Failed to upload trades'
         }), 500
@@ -202,10 +483,10 @@ def upload_trades():
 @app.route('/api/test')
 def test_firebase():
     try:
-        trades = dashboard.get_trades_from_firebase(1)
-        trade_count = len(dashboard.get_trades_from_firebase(1000))
+        trades, _ = dashboard.get_trades_from_firebase(1)
+        trade_count = dashboard.count_trades()
         
-        return jsonify({
+        return fast_json({
             'firebase_connected': True,
             'trade_count': trade_count,
             'sample_trade': trades[0] if trades else None,
@@ -215,11 +496,11 @@ def test_firebase():
         })
         
     except Exception as e:
-        return jsonify({
+        return fast_json({
             'firebase_connected': False,
             'error': str(e),
             'message': 'Firebase connection failed'
-        }), 500
+        }, 500)
 
 @app.route('/health')
 def health_check():
@@ -240,6 +521,8 @@ def log_routes():
         print(f"  {rule.endpoint:30s} {methods:20s} {rule}")
     print("="*50 + "\n")
 
+# Local development only. In production run under gunicorn's gevent worker:
+#   gunicorn app:app
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     print(f"🚀 Starting Forex Dashboard on port {port}")
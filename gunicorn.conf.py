@@ -0,0 +1,17 @@
+import os
+
+# The app spends nearly all of its time waiting on Firestore RPCs, so a
+# couple of gevent workers serving many connections each is plenty.
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gevent'
+worker_connections = 1000
+
+
+def post_worker_init(worker):
+    # Runs after the fork, once gevent has patched the worker and loaded
+    # app.py, so each worker initializes Firebase before its first request.
+    # get_db() would do the same lazily if this hook didn't run.
+    from app import init_firebase
+
+    init_firebase()
@@ -0,0 +1,66 @@
+"""One-off migration for trades written before uploads were normalized.
+
+Firestore's sum('profit') and profit > 0 aggregations behind /api/stats
+skip string values while count() includes them, so any trade still
+holding its profit as a string skews the stats until this has run.
+The equity curve orders by timestamp_ms, and Firestore leaves documents
+without that field out of the query, so older trades are not charted
+until it is backfilled here.
+
+Run once against production from the new version's checkout, before that
+version starts serving traffic (the trades ETag can't see in-place rewrites):
+    python migrate_trades.py
+It is safe to run again; documents that are already migrated are skipped.
+"""
+from app import FIRESTORE_BATCH_LIMIT, get_db, timestamp_to_ms
+
+def migrated_fields(trade_data):
+    """Fields that need rewriting for one stored trade"""
+    updates = {}
+
+    profit = trade_data.get('profit', 0)
+    if isinstance(profit, str):
+        updates['profit'] = float(profit)
+
+    if 'timestamp_ms' not in trade_data:
+        timestamp_ms = timestamp_to_ms(trade_data.get('timestamp'))
+        if timestamp_ms is None:
+            raise ValueError(f"unrecognized timestamp {trade_data.get('timestamp')!r}")
+        updates['timestamp_ms'] = timestamp_ms
+
+    return updates
+
+def migrate_trades():
+    db = get_db()
+    batch = db.batch()
+    batch_size = 0
+    migrated_count = 0
+    failed_count = 0
+
+    for doc in db.collection('trades').stream():
+        try:
+            updates = migrated_fields(doc.to_dict())
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ Skipping {doc.id}: {e}")
+            failed_count += 1
+            continue
+
+        if not updates:
+            continue
+
+        batch.update(doc.reference, updates)
+        batch_size += 1
+        migrated_count += 1
+
+        if batch_size == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            batch_size = 0
+
+    if batch_size:
+        batch.commit()
+
+    print(f"✅ Migrated {migrated_count} trades, {failed_count} could not be migrated")
+
+if __name__ == '__main__':
+    migrate_trades()